@@ -13,14 +13,17 @@ Date: 2025-09-03
 Version: 1.0.0
 """
 
+import hashlib
+import io
 import os
 import tempfile
+import shutil
 import requests
-import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
-from minio import Minio
-from docling.document_converter import DocumentConverter
-from docling_core.types.doc.base import ImageRefMode
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 # MinIO 配置
@@ -29,85 +32,247 @@ MINIO_ACCESS_KEY = "minioadmin"
 MINIO_SECRET_KEY = "minioadmin"
 MINIO_BUCKET = "md-images"
 MINIO_BASE_URL = "http://10.3.70.127:9000"
+MINIO_UPLOAD_WORKERS = 8
 
-def upload_file_to_minio(file_path, object_name):
-    """上传文件到 MinIO 对象存储"""
+# 下载超时 (连接, 读取)，单位秒
+HTTP_TIMEOUT = (5, 60)
+# 小于该大小的文档直接在内存中转换，更大的文档落盘后再转换
+IN_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+
+# 模块级共享的 HTTP 会话，复用 TCP/TLS 连接
+_HTTP = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+)
+_HTTP.mount("http://", _HTTP_ADAPTER)
+_HTTP.mount("https://", _HTTP_ADAPTER)
+
+# 模块级共享的 MinIO 客户端，首次上传时创建；
+# SDK 默认连接池 (10) 已大于上传线程数，所有线程共用其长连接
+_MINIO_CLIENT = None
+_MINIO_LOCK = threading.Lock()
+_BUCKET_READY = False
+_BUCKET_LOCK = threading.Lock()
+
+def _get_minio_client():
+    """获取共享的 MinIO 客户端，首次调用时初始化；未安装 minio 时直接抛出异常"""
+    global _MINIO_CLIENT
+    if _MINIO_CLIENT is None:
+        with _MINIO_LOCK:
+            if _MINIO_CLIENT is None:
+                from minio import Minio
+                
+                _MINIO_CLIENT = Minio(
+                    MINIO_ENDPOINT,
+                    access_key=MINIO_ACCESS_KEY,
+                    secret_key=MINIO_SECRET_KEY,
+                    secure=False
+                )
+    return _MINIO_CLIENT
+
+def _ensure_bucket(client):
+    """确保存储桶存在，整个进程只检查一次"""
+    global _BUCKET_READY
+    if _BUCKET_READY:
+        return
+    with _BUCKET_LOCK:
+        if not _BUCKET_READY:
+            if not client.bucket_exists(MINIO_BUCKET):
+                client.make_bucket(MINIO_BUCKET)
+            _BUCKET_READY = True
+
+_CONVERTER = None
+_CONVERTER_LOCK = threading.Lock()
+
+def _get_converter():
+    """获取共享的 DocumentConverter，首次调用时初始化"""
+    global _CONVERTER
+    if _CONVERTER is None:
+        with _CONVERTER_LOCK:
+            if _CONVERTER is None:
+                from docling.document_converter import DocumentConverter
+                
+                _CONVERTER = DocumentConverter()
+    return _CONVERTER
+
+def _content_digest(data):
+    """计算文件内容哈希，用于去重和对象命名"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def upload_bytes_to_minio(data, object_name, digest=None):
+    """上传内存中的文件内容到 MinIO 对象存储，按内容哈希命名，已存在则跳过"""
+    client = _get_minio_client()
+    from minio.error import S3Error
+    
     try:
-        client = Minio(
-            MINIO_ENDPOINT,
-            access_key=MINIO_ACCESS_KEY,
-            secret_key=MINIO_SECRET_KEY,
-            secure=False
-        )
-        
-        if not client.bucket_exists(MINIO_BUCKET):
-            client.make_bucket(MINIO_BUCKET)
+        _ensure_bucket(client)
         
-        unique_filename = f"{uuid.uuid4()}_{object_name}"
+        if digest is None:
+            digest = _content_digest(data)
+        suffix = Path(object_name).suffix or ".png"
+        content_filename = f"{digest}{suffix}"
         
-        client.fput_object(
-            MINIO_BUCKET,
-            unique_filename,
-            file_path,
-            content_type="image/png"
-        )
+        try:
+            client.stat_object(MINIO_BUCKET, content_filename)
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                raise
+            client.put_object(
+                MINIO_BUCKET,
+                content_filename,
+                io.BytesIO(data),
+                length=len(data),
+                content_type="image/png"
+            )
         
-        return f"{MINIO_BASE_URL}/{MINIO_BUCKET}/{unique_filename}"
+        return f"{MINIO_BASE_URL}/{MINIO_BUCKET}/{content_filename}"
         
     except Exception as e:
         print(f"⚠️ 文件上传失败: {e}")
         return None
 
+def upload_file_to_minio(file_path, object_name):
+    """上传文件到 MinIO 对象存储"""
+    try:
+        with open(file_path, 'rb') as fp:
+            data = fp.read()
+    except Exception as e:
+        print(f"⚠️ 文件上传失败: {e}")
+        return None
+    return upload_bytes_to_minio(data, object_name)
+
+# Markdown 图片引用，group(2) 为图片文件名
+_IMAGE_REF_RE = re.compile(r'!\[[^\]]*\]\(([^)]*?)([^/)]+\.png)[^)]*\)')
+
 def process_referenced_images(artifacts_dir, markdown_content):
     """处理REFERENCED模式生成的图片文件，上传到MinIO并更新链接"""
     
-    if not artifacts_dir or not artifacts_dir.exists():
+    if not artifacts_dir:
         return markdown_content
     
-    image_files = list(artifacts_dir.glob("*.png"))
+    # 与替换使用同一个正则，单次扫描收集 Markdown 中引用的图片，未引用的图片不上传
+    referenced = {match.group(2) for match in _IMAGE_REF_RE.finditer(markdown_content)}
+    
+    # 单次 readdir 列出图片，目录不存在时直接返回
+    try:
+        with os.scandir(artifacts_dir) as entries:
+            image_files = [
+                entry for entry in entries
+                if entry.name.endswith(".png") and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return markdown_content
     
     if not image_files:
         print("📸 没有找到图片文件")
         return markdown_content
     
-    print(f"📸 找到 {len(image_files)} 张图片，正在上传到 MinIO...")
+    unreferenced = len(image_files)
+    image_files = [entry for entry in image_files if entry.name in referenced]
+    unreferenced -= len(image_files)
+    if unreferenced:
+        print(f"📸 跳过 {unreferenced} 张未被 Markdown 引用的图片")
+    
+    if not image_files:
+        return markdown_content
     
+    # 按内容哈希分组，重复出现的图片只上传一次
+    groups = {}
     for image_file in image_files:
         try:
-            minio_url = upload_file_to_minio(str(image_file), image_file.name)
-            
-            if minio_url:
-                pattern = rf'!\[[^\]]*\]\([^)]*{re.escape(image_file.name)}[^)]*\)'
-                new_image_ref = f'![Image]({minio_url})'
-                markdown_content = re.sub(pattern, new_image_ref, markdown_content)
-                
-                print(f"✅ 图片已上传并替换: {image_file.name} -> {minio_url}")
-            
+            with open(image_file.path, 'rb') as fp:
+                data = fp.read()
         except Exception as e:
             print(f"⚠️ 处理图片 {image_file.name} 失败: {e}")
+            continue
+        digest = _content_digest(data)
+        groups.setdefault(digest, (data, []))[1].append(image_file.name)
+    
+    print(f"📸 找到 {len(image_files)} 张图片（去重后 {len(groups)} 张），正在上传到 MinIO...")
+    
+    # 在线程池外创建客户端，缺少 minio 依赖时直接失败而不是逐张图片报错
+    _get_minio_client()
+    
+    uploaded = []
+    with ThreadPoolExecutor(max_workers=MINIO_UPLOAD_WORKERS) as executor:
+        futures = {
+            executor.submit(upload_bytes_to_minio, data, image_names[0], digest): image_names
+            for digest, (data, image_names) in groups.items()
+        }
+        for future in as_completed(futures):
+            image_names = futures[future]
+            try:
+                minio_url = future.result()
+                if minio_url:
+                    uploaded.extend((image_name, minio_url) for image_name in image_names)
+            except Exception as e:
+                print(f"⚠️ 处理图片 {image_names[0]} 失败: {e}")
+    
+    if not uploaded:
+        return markdown_content
+    
+    # 单次扫描替换所有图片引用，结果只拼接一次，避免每张图片都复制一遍全文
+    name_to_url = dict(uploaded)
+    
+    def replace_image_ref(match):
+        minio_url = name_to_url.get(match.group(2))
+        if minio_url is None:
+            return match.group(0)
+        return f'![Image]({minio_url})'
+    
+    markdown_content = _IMAGE_REF_RE.sub(replace_image_ref, markdown_content)
+    
+    for image_name, minio_url in uploaded:
+        print(f"✅ 图片已上传并替换: {image_name} -> {minio_url}")
     
     return markdown_content
 
+def _buffer_download(raw, limit):
+    """将下载内容读入内存，超过 limit 字节时停止并返回已读部分"""
+    buf = io.BytesIO()
+    while buf.tell() <= limit:
+        chunk = raw.read(1024 * 1024)
+        if not chunk:
+            buf.seek(0)
+            return buf, True
+        buf.write(chunk)
+    return buf, False
+
 def word_to_markdown_from_url(url, use_referenced_mode=True):
     """从 URL 下载 Word 文档并转换为 Markdown"""
+    from docling.datamodel.base_models import DocumentStream
+    from docling_core.types.doc.base import ImageRefMode
     
-    converter = DocumentConverter()
+    converter = _get_converter()
     
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_path = Path(temp_dir)
         
         print("📥 正在下载Word文档...")
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        temp_file = temp_path / "document.docx"
-        with open(temp_file, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        # 出错时也要关闭响应，连接才能归还到 _HTTP 的连接池
+        with _HTTP.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            
+            # 压缩传输时 Content-Length 是压缩后的大小，因此按实际解码后的字节数限制内存缓冲
+            buf, complete = None, False
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if 0 < content_length <= IN_MEMORY_MAX_BYTES:
+                buf, complete = _buffer_download(response.raw, IN_MEMORY_MAX_BYTES)
+            
+            if complete:
+                source = DocumentStream(name="document.docx", stream=buf)
+            else:
+                source = temp_path / "document.docx"
+                with open(source, 'wb') as f:
+                    if buf is not None:
+                        f.write(buf.getbuffer())
+                    shutil.copyfileobj(response.raw, f, length=1024 * 1024)
         
         print("🔄 正在转换文档...")
-        result = converter.convert(temp_file)
+        result = converter.convert(source)
         
         if use_referenced_mode:
             output_dir = temp_path / "output"
@@ -122,8 +287,8 @@ def word_to_markdown_from_url(url, use_referenced_mode=True):
                 image_mode=ImageRefMode.REFERENCED
             )
             
-            with open(markdown_file, 'r', encoding='utf-8') as f:
-                markdown_content = f.read()
+            # Docling 没有返回字符串且同时写出图片的公开接口，只能读回 save_as_markdown 的结果
+            markdown_content = markdown_file.read_text(encoding='utf-8')
             
             print("🖼️ 正在处理图片...")
             markdown_content = process_referenced_images(artifacts_dir, markdown_content)
@@ -153,8 +318,8 @@ def main():
         print(f"🖼️ 图片位置: 保持在原始文档位置")
         
         output_file = "output_improved.md"
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(markdown)
+        with open(output_file, "wb", buffering=1024 * 1024) as f:
+            f.write(markdown.encode("utf-8"))
         
         print(f"💾 完整结果已保存到 {output_file}")
         